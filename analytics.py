@@ -0,0 +1,182 @@
+import asyncio, sqlite3, time
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+# верхние границы корзин латентности, мс (последняя — «всё, что больше»)
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 5000, 10000, 20000, 60000, 10**9)
+
+
+def _ymd(ts: Optional[float] = None) -> str:
+    return datetime.fromtimestamp(ts if ts is not None else time.time(), tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def _bucket(ms: float) -> int:
+    return LATENCY_BUCKETS_MS[min(bisect_left(LATENCY_BUCKETS_MS, ms), len(LATENCY_BUCKETS_MS) - 1)]
+
+
+class Analytics:
+    """Инкрементальные агрегаты по событиям (день × тариф × тип × модель,
+    корзины латентности, токены). record() копит счётчики в памяти, flush()
+    сбрасывает их одним upsert-пакетом — отчёты читают только агрегаты.
+    compact() сворачивает старые построчные usage_daily в usage_archive."""
+
+    def __init__(self, db: sqlite3.Connection, db_path: str, flush_every_s: float = 10.0,
+                 usage_keep_days: int = 35, compact_every_s: float = 3600.0, compact_batch: int = 5000):
+        self.db = db
+        self.db_path = db_path
+        self.flush_every_s = flush_every_s
+        self.usage_keep_days = usage_keep_days
+        self.compact_every_s = compact_every_s
+        self.compact_batch = compact_batch
+        self._agg: Dict[Tuple[str, str, str, str], List[int]] = defaultdict(lambda: [0, 0, 0, 0, 0])
+        self._lat: Dict[Tuple[str, str, int], int] = defaultdict(int)
+        self._task: Optional[asyncio.Task] = None
+        self.ensure()
+
+    def ensure(self):
+        c = self.db.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS stats_daily(
+            ymd TEXT, plan TEXT, kind TEXT, model TEXT,
+            events INTEGER DEFAULT 0, ok INTEGER DEFAULT 0,
+            tokens_in INTEGER DEFAULT 0, tokens_out INTEGER DEFAULT 0, latency_ms INTEGER DEFAULT 0,
+            PRIMARY KEY(ymd, plan, kind, model)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS stats_latency(
+            ymd TEXT, kind TEXT, bucket_ms INTEGER, cnt INTEGER DEFAULT 0,
+            PRIMARY KEY(ymd, kind, bucket_ms)
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS usage_archive(
+            ymd TEXT PRIMARY KEY, chats INTEGER DEFAULT 0, text_cnt INTEGER DEFAULT 0, img_cnt INTEGER DEFAULT 0
+        )""")
+        self.db.commit()
+
+    # ---- запись ----
+    def record(self, kind: str, plan: str, model: Optional[str], latency_s: float,
+               ok: bool = True, tokens_in: int = 0, tokens_out: int = 0):
+        ymd = _ymd()
+        a = self._agg[(ymd, plan or "-", kind, model or "-")]
+        a[0] += 1
+        a[1] += 1 if ok else 0
+        a[2] += int(tokens_in or 0)
+        a[3] += int(tokens_out or 0)
+        ms = latency_s * 1000.0
+        a[4] += int(ms)
+        self._lat[(ymd, kind, _bucket(ms))] += 1
+
+    def flush(self):
+        if not self._agg and not self._lat:
+            return
+        agg, lat = self._agg, self._lat
+        self._agg = defaultdict(lambda: [0, 0, 0, 0, 0])
+        self._lat = defaultdict(int)
+        self.db.executemany(
+            "INSERT INTO stats_daily(ymd,plan,kind,model,events,ok,tokens_in,tokens_out,latency_ms) "
+            "VALUES(?,?,?,?,?,?,?,?,?) ON CONFLICT(ymd,plan,kind,model) DO UPDATE SET "
+            "events=events+excluded.events, ok=ok+excluded.ok, tokens_in=tokens_in+excluded.tokens_in, "
+            "tokens_out=tokens_out+excluded.tokens_out, latency_ms=latency_ms+excluded.latency_ms",
+            [(*k, *v) for k, v in agg.items()])
+        self.db.executemany(
+            "INSERT INTO stats_latency(ymd,kind,bucket_ms,cnt) VALUES(?,?,?,?) "
+            "ON CONFLICT(ymd,kind,bucket_ms) DO UPDATE SET cnt=cnt+excluded.cnt",
+            [(*k, v) for k, v in lat.items()])
+        self.db.commit()
+
+    # ---- чтение ----
+    def report(self, days: int = 7) -> Dict:
+        """Сводка за последние `days` дней (включая сегодня) только по агрегатам."""
+        self.flush()
+        since = _ymd(time.time() - (max(1, days) - 1) * 86400)
+        rows = self.db.execute(
+            "SELECT ymd, plan, kind, SUM(events), SUM(ok), SUM(tokens_in), SUM(tokens_out), SUM(latency_ms) "
+            "FROM stats_daily WHERE ymd>=? GROUP BY ymd, plan, kind ORDER BY ymd DESC, kind, plan", (since,)).fetchall()
+        models = self.db.execute(
+            "SELECT kind, model, SUM(ok) FROM stats_daily WHERE ymd>=? AND ok>0 GROUP BY kind, model "
+            "ORDER BY kind, SUM(ok) DESC", (since,)).fetchall()
+        hist: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for kind, b, cnt in self.db.execute(
+                "SELECT kind, bucket_ms, SUM(cnt) FROM stats_latency WHERE ymd>=? GROUP BY kind, bucket_ms "
+                "ORDER BY kind, bucket_ms", (since,)):
+            hist[kind].append((b, cnt))
+        return {
+            "since": since,
+            "daily": [{"ymd": r[0], "plan": r[1], "kind": r[2], "events": r[3], "ok": r[4],
+                       "tokens_in": r[5], "tokens_out": r[6],
+                       "latency_avg_ms": round(r[7] / r[3]) if r[3] else 0} for r in rows],
+            "models": [{"kind": k, "model": m, "ok": n} for k, m, n in models],
+            "latency": {k: {"p50_ms": _pct(h, 0.5), "p95_ms": _pct(h, 0.95),
+                            "buckets": {str(b): c for b, c in h}} for k, h in hist.items()},
+        }
+
+    # ---- обслуживание ----
+    def compact(self) -> int:
+        """usage_daily старше usage_keep_days -> usage_archive (по дню, без chat_id).
+        Своё соединение — звать через asyncio.to_thread. Строки переносятся
+        пачками по compact_batch, каждая пачка — своя короткая транзакция,
+        чтобы не держать блокировку записи для остальных."""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.usage_keep_days)).strftime("%Y-%m-%d")
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        n = 0
+        try:
+            while True:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("CREATE TEMP TABLE IF NOT EXISTS _compact(rid INTEGER PRIMARY KEY)")
+                    conn.execute("DELETE FROM _compact")
+                    k = conn.execute("INSERT INTO _compact SELECT rowid FROM usage_daily WHERE ymd<? LIMIT ?",
+                                     (cutoff, self.compact_batch)).rowcount
+                    if k:
+                        conn.execute(
+                            "INSERT INTO usage_archive(ymd,chats,text_cnt,img_cnt) "
+                            "SELECT ymd, COUNT(*), SUM(text_cnt), SUM(img_cnt) FROM usage_daily "
+                            "WHERE rowid IN (SELECT rid FROM _compact) GROUP BY ymd "
+                            "ON CONFLICT(ymd) DO UPDATE SET chats=chats+excluded.chats, "
+                            "text_cnt=text_cnt+excluded.text_cnt, img_cnt=img_cnt+excluded.img_cnt")
+                        conn.execute("DELETE FROM usage_daily WHERE rowid IN (SELECT rid FROM _compact)")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                n += k
+                if k < self.compact_batch:
+                    break
+        finally:
+            conn.close()
+        if n:
+            print(f"[STATS] compacted {n} usage_daily rows older than {cutoff}")
+        return n
+
+    async def _loop(self):
+        last_compact = 0.0
+        while True:
+            await asyncio.sleep(self.flush_every_s)
+            try:
+                self.flush()
+                if time.monotonic() - last_compact >= self.compact_every_s:
+                    last_compact = time.monotonic()
+                    await asyncio.to_thread(self.compact)
+            except Exception as e:
+                print(f"[STATS-ERR] {type(e).__name__}: {e}")
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.flush()
+
+
+def _pct(hist: List[Tuple[int, int]], p: float) -> int:
+    """Перцентиль по гистограмме: верхняя граница корзины, в которую он попал."""
+    total = sum(c for _, c in hist)
+    acc = 0
+    for b, c in hist:
+        acc += c
+        if acc >= p * total:
+            return b
+    return hist[-1][0] if hist else 0
@@ -0,0 +1,118 @@
+import asyncio, os, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from shutil import which
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+SR = 16000            # Whisper всё равно работает с 16 kHz mono
+FRAME_MS = 30
+PAD_MS = 250          # тишина короче 2*PAD_MS остаётся как есть, длиннее — ужимается до 2*PAD_MS
+MIN_SPEECH_MS = 300
+OPUS_BITRATE = "24k"
+
+CHUNK_S = float(os.getenv("VOICE_CHUNK_S", "60"))
+_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("AUDIO_WORKERS", "2")), thread_name_prefix="audio")
+
+
+def _ffmpeg(args: List[str], data: Union[bytes, bytearray]) -> Optional[bytes]:
+    try:
+        p = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", *args],
+                           input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120, check=True)
+        return p.stdout
+    except Exception as e:
+        print(f"[AUDIO-ERR] ffmpeg {type(e).__name__}: {e}")
+        return None
+
+
+def decode(data: Union[bytes, bytearray]) -> Optional[np.ndarray]:
+    """Любой входной формат -> int16 PCM 16 kHz mono за один проход ffmpeg
+    (декодирование, даунмикс и ресемплинг вместе)."""
+    raw = _ffmpeg(["-i", "pipe:0", "-vn", "-ac", "1", "-ar", str(SR), "-f", "s16le", "pipe:1"], data)
+    if raw is None:
+        return None
+    return np.frombuffer(raw, dtype=np.int16)
+
+
+def encode(pcm: np.ndarray) -> Optional[bytes]:
+    return _ffmpeg(["-f", "s16le", "-ar", str(SR), "-ac", "1", "-i", "pipe:0",
+                    "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip", "-f", "ogg", "pipe:1"],
+                   pcm.astype(np.int16, copy=False).tobytes())
+
+
+def frame_energy_db(pcm: np.ndarray, frame: int) -> np.ndarray:
+    n = len(pcm) // frame
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    x = pcm[:n * frame].reshape(n, frame).astype(np.float32) / 32768.0
+    return 10.0 * np.log10(np.mean(x * x, axis=1) + 1e-10)
+
+
+def voiced_mask(energy_db: np.ndarray, pad_frames: int) -> np.ndarray:
+    """Энергетический VAD: порог = шумовой пол (10-й перцентиль) + 12 дБ, но не
+    выше 90-го перцентиля - 6 дБ (запись без пауз не режется целиком) и не ниже
+    -50 dBFS; найденная речь расширяется на pad_frames в обе стороны."""
+    if energy_db.size == 0:
+        return np.zeros(0, dtype=bool)
+    p10, p90 = np.percentile(energy_db, [10, 90])
+    thr = max(min(float(p10) + 12.0, float(p90) - 6.0), -50.0)
+    voiced = energy_db > thr
+    if pad_frames > 0 and voiced.any():
+        voiced = np.convolve(voiced.astype(np.int8), np.ones(2 * pad_frames + 1, dtype=np.int8), "same") > 0
+    return voiced
+
+
+def trim_silence(pcm: np.ndarray) -> np.ndarray:
+    frame = SR * FRAME_MS // 1000
+    mask = voiced_mask(frame_energy_db(pcm, frame), PAD_MS // FRAME_MS)
+    if mask.sum() * FRAME_MS < MIN_SPEECH_MS:
+        return pcm[:0]
+    keep = np.repeat(mask, frame)
+    tail = pcm[len(keep):] if mask[-1] else pcm[:0]
+    return np.concatenate([pcm[:len(keep)][keep], tail])
+
+
+def split(pcm: np.ndarray, chunk_s: float = CHUNK_S, search_s: float = 5.0) -> List[np.ndarray]:
+    """Режем на куски не длиннее chunk_s: граница — самый тихий кадр в
+    последних search_s секундах куска, чтобы не разрезать слово."""
+    limit = int(chunk_s * SR)
+    if chunk_s <= 0 or len(pcm) <= limit:
+        return [pcm]
+    frame = SR * FRAME_MS // 1000
+    out, start = [], 0
+    while len(pcm) - start > limit:
+        lo = start + max(frame, limit - int(search_s * SR))
+        e = frame_energy_db(pcm[lo:start + limit], frame)
+        cut = lo + int(np.argmin(e)) * frame if e.size else start + limit
+        out.append(pcm[start:cut])
+        start = cut
+    out.append(pcm[start:])
+    return out
+
+
+def prepare(data: Union[bytes, bytearray], name: str = "voice.ogg") -> List[Tuple[str, bytes]]:
+    """Голосовое -> список (имя файла, ogg/opus 16 kHz mono) для распознавания.
+    Пустой список — в записи нет речи. Без ffmpeg возвращается исходный файл
+    (bytearray приводится к bytes только здесь — multipart его не принимает)."""
+    if not which("ffmpeg"):
+        return [(name, bytes(data))]
+    pcm = decode(data)
+    if pcm is None:
+        return [(name, bytes(data))]
+    speech = trim_silence(pcm)
+    if speech.size == 0:
+        return []
+    out = []
+    for i, part in enumerate(split(speech)):
+        enc = encode(part)
+        if enc is None:
+            return [(name, bytes(data))]
+        out.append((f"voice_{i}.ogg", enc))
+    print(f"[AUDIO] {len(data)} B, {len(pcm) / SR:.1f}s -> speech {speech.size / SR:.1f}s, "
+          f"{len(out)} chunk(s), {sum(len(b) for _, b in out)} B")
+    return out
+
+
+async def prepare_async(data: Union[bytes, bytearray], name: str = "voice.ogg") -> List[Tuple[str, bytes]]:
+    """prepare() в пуле потоков: ffmpeg и NumPy не держат event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_POOL, prepare, data, name)
@@ -0,0 +1,60 @@
+"""RagStore: f32 / f16 / int8 против точного float32-поиска и старого JSON-формата.
+Синтетика: кластеризованные векторы, запросы — зашумлённые копии хранимых.
+
+    python bench/rag_store_bench.py [N] [dim] [queries]
+"""
+import os, sys, json, shutil, tempfile, time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag_store import RagStore
+
+K = 10
+
+
+def dataset(n, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 100), dim)).astype(np.float32)
+    x = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+    return x.astype(np.float32), rng
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+    nq = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    x, rng = dataset(n, dim)
+    queries = x[rng.integers(0, n, nq)] + 0.3 * rng.normal(size=(nq, dim)).astype(np.float32)
+    xn = x / np.linalg.norm(x, axis=1, keepdims=True)
+    truth = [set(np.argsort(-(xn @ (q / np.linalg.norm(q))))[:K].tolist()) for q in queries]
+    texts = [f"chunk {i}" for i in range(n)]
+
+    sample = 1000  # старый формат: размер экстраполируется по первым записям
+    json_bytes = sum(len(json.dumps({"id": "0" * 36, "source_id": "doc", "text": texts[i],
+                                     "embedding": x[i].tolist()}, ensure_ascii=False)) + 1
+                     for i in range(min(sample, n))) * n / min(sample, n)
+    print(f"N={n} dim={dim} queries={nq}; legacy index.jsonl ≈ {json_bytes / 2**20:,.1f} MiB")
+
+    base = None
+    print(f"{'quant':5} {'disk MiB':>9} {'vec MiB':>8} {'vs json':>8} {'vs f32':>7} {'recall@10':>9} {'ms/query':>9}")
+    for quant in ("f32", "f16", "int8"):
+        d = tempfile.mkdtemp()
+        try:
+            store = RagStore(d, quant=quant)
+            for i in range(0, n, 5000):  # как несколько документов
+                store.add_chunks(f"doc{i // 5000}", texts[i:i + 5000], x[i:i + 5000])
+            store.compact()
+            st = store.stats()
+            t0 = time.perf_counter()
+            hits = [store.search(q, K) for q in queries]
+            ms = (time.perf_counter() - t0) * 1000 / nq
+            recall = np.mean([len({int(h["text"].split()[1]) for h in hs} & t) / K for hs, t in zip(hits, truth)])
+            base = base or st["vector_bytes"]
+            print(f"{quant:5} {st['disk_bytes'] / 2**20:9.1f} {st['vector_bytes'] / 2**20:8.1f} "
+                  f"{json_bytes / st['disk_bytes']:7.1f}x {base / st['vector_bytes']:6.1f}x {recall:9.3f} {ms:9.2f}")
+        finally:
+            shutil.rmtree(d)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Выпуск и активация кодов: старый путь (commit на каждый код) против
+redeem_codes.issue_codes, плюс проверка гонки при одновременной активации.
+
+    python bench/redeem_codes_bench.py [кол-во] [кол-во_для_старого_пути]
+"""
+import os, sys, sqlite3, tempfile, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import redeem_codes
+
+
+def _db(path):
+    db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    db.execute("PRAGMA journal_mode=WAL;")
+    db.execute("CREATE TABLE IF NOT EXISTS redeem_codes(code TEXT PRIMARY KEY, plan TEXT, days INTEGER, used INTEGER DEFAULT 0)")
+    db.commit()
+    redeem_codes.ensure(db)
+    return db
+
+
+def legacy(db, count):
+    for _ in range(count):
+        db.execute("INSERT INTO redeem_codes(code,plan,days,used) VALUES(?,?,?,0)",
+                   (redeem_codes.gen_code(), "standard", 30))
+        db.commit()
+
+
+def race(path, codes, threads=8):
+    """Все потоки пытаются активировать одни и те же коды."""
+    wins = [0] * threads
+    barrier = threading.Barrier(threads)
+
+    def worker(i):
+        conn = sqlite3.connect(path, timeout=30)
+        barrier.wait()
+        for c in codes:
+            status, _ = redeem_codes.claim(conn, c, 1000 + i)
+            conn.commit()
+            wins[i] += status == "ok"
+        conn.close()
+
+    ts = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    return sum(wins)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n_legacy = int(sys.argv[2]) if len(sys.argv) > 2 else min(n, 2000)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "bench.db")
+        db = _db(path)
+
+        t0 = time.perf_counter(); legacy(db, n_legacy); t_old = time.perf_counter() - t0
+        print(f"legacy   {n_legacy:>7} codes: {t_old:7.3f}s  ({n_legacy / t_old:,.0f} codes/s)")
+
+        t0 = time.perf_counter(); batch, codes = redeem_codes.issue_codes(path, "standard", 30, n); t_new = time.perf_counter() - t0
+        print(f"batched  {len(codes):>7} codes: {t_new:7.3f}s  ({len(codes) / t_new:,.0f} codes/s)")
+        print(f"speedup per code: x{(t_old / n_legacy) / (t_new / len(codes)):.0f}")
+
+        t0 = time.perf_counter(); rows, data = redeem_codes.export_csv(path, batch); t_csv = time.perf_counter() - t0
+        print(f"export   {rows:>7} rows : {t_csv:7.3f}s  ({len(data) / 1024:,.0f} KiB)")
+
+        sample = codes[:500]
+        wins = race(path, sample)
+        print(f"race: {len(sample)} codes x 8 threads -> {wins} successful redemptions "
+              f"({'OK' if wins == len(sample) else 'DOUBLE REDEEM'})")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
-import os, time, base64, sqlite3, traceback, subprocess
+import os, time, base64, sqlite3, traceback, subprocess, tempfile, asyncio
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime, timezone
 from typing import Optional, Tuple
 from shutil import which
@@ -14,8 +16,17 @@ from telegram.ext import (
     ContextTypes, filters
 )
 
+import httpx
 from openai import OpenAI, BadRequestError, PermissionDeniedError
 
+from gen_queue import GenQueue, ModelLimiter, parse_model_limits
+from scheduler import FairScheduler, Overloaded, parse_weights
+import redeem_codes
+from broadcast import Broadcaster
+from analytics import Analytics
+import audio_prep
+from profiler import stage, timed, trace
+
 # ========= ENV =========
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 OPENAI_API_KEY     = os.getenv("OPENAI_API_KEY", "")
@@ -31,6 +42,8 @@ IMAGE_PREFS = [
 
 OPENAI_TTS_VOICE = os.getenv("OPENAI_TTS_VOICE", "alloy")
 OPENAI_TIMEOUT_S = float(os.getenv("OPENAI_TIMEOUT_S", "60"))
+HTTP_TIMEOUT_S   = float(os.getenv("HTTP_TIMEOUT_S", "60"))
+VOICE_PARALLEL   = int(os.getenv("VOICE_PARALLEL", "2"))  # кусков одного голосового в распознавании одновременно
 
 PAYMENT_URL_STANDARD = os.getenv("PAYMENT_URL_STANDARD", "https://example.com/pay-standard")
 PAYMENT_URL_PREMIUM  = os.getenv("PAYMENT_URL_PREMIUM",  "https://example.com/pay-premium")
@@ -42,9 +55,58 @@ STANDARD_IMG_MONTH = int(os.getenv("STANDARD_IMG_MONTHLY", "20"))
 
 PLAN_FREE, PLAN_STANDARD, PLAN_PREMIUM = "free", "standard", "premium"
 
+# ========= Scheduler (общий бюджет вызовов моделей, доли по тарифам) =========
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", "16"))
+SCHED = FairScheduler(
+    MODEL_CONCURRENCY,
+    parse_weights(os.getenv("SCHED_WEIGHTS", "")) or {PLAN_FREE: 1, PLAN_STANDARD: 3, PLAN_PREMIUM: 6},
+    deadlines={PLAN_FREE: float(os.getenv("FREE_MAX_WAIT_S", "20"))},
+    starvation_s=float(os.getenv("SCHED_STARVATION_S", "30")),
+)
+# синхронный клиент OpenAI — в своём пуле на MODEL_CONCURRENCY потоков: выданный
+# слот = реально идущий вызов (общий пул to_thread мал и занят другими задачами)
+_MODEL_POOL = ThreadPoolExecutor(max_workers=MODEL_CONCURRENCY, thread_name_prefix="model")
+
+async def _model_call(fn, /, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_MODEL_POOL, partial(fn, *args, **kwargs))
+
+BUSY_TEXT = "⏳ Сейчас высокая нагрузка. Попробуйте через минуту или оформите тариф в меню «💳 Тарифы»."
+
 def _client():
     return OpenAI(api_key=OPENAI_API_KEY)
 
+# ========= HTTP (общий async-клиент, keep-alive) =========
+_HTTP: Optional[httpx.AsyncClient] = None
+
+def http_client()->httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None or _HTTP.is_closed:
+        _HTTP = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT_S,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        )
+    return _HTTP
+
+async def close_http_client():
+    global _HTTP
+    if _HTTP is not None and not _HTTP.is_closed:
+        await _HTTP.aclose()
+    _HTTP = None
+
+async def _download_to_tmp(url:str, suffix:str=".png")->str:
+    """Качаем файл потоково во временный файл, не держа его целиком в памяти."""
+    fd, path = tempfile.mkstemp(prefix="dl_", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async with http_client().stream("GET", url) as r:
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes(64*1024):
+                    f.write(chunk)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path
+
 # ========= DB (SQLite) =========
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 
@@ -71,6 +133,7 @@ class DB:
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER, ts REAL, kind TEXT, prompt TEXT, response TEXT
         )""")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_history_chat ON history(chat_id, ts)")
         c.execute("""CREATE TABLE IF NOT EXISTS settings(
             chat_id INTEGER PRIMARY KEY,
             voice_reply INTEGER DEFAULT 0,
@@ -82,13 +145,25 @@ class DB:
         self.db.commit()
 
     def exec(self, q, p=()):
-        self.db.execute(q,p); self.db.commit()
+        with stage("db"): self.db.execute(q,p); self.db.commit()
     def one(self, q, p=()):
-        cur=self.db.execute(q,p); return cur.fetchone()
+        with stage("db"): cur=self.db.execute(q,p); return cur.fetchone()
     def all(self, q, p=()):
-        cur=self.db.execute(q,p); return cur.fetchall()
+        with stage("db"): cur=self.db.execute(q,p); return cur.fetchall()
 
 DBI=DB(DB_PATH)
+redeem_codes.ensure(DBI.db)
+ANALYTICS=Analytics(DBI.db, DB_PATH, usage_keep_days=int(os.getenv("USAGE_KEEP_DAYS", "35")))
+
+# ========= Image queue (фоновая генерация, лимиты по моделям) =========
+IMAGE_WORKERS             = int(os.getenv("IMAGE_WORKERS", "4"))
+IMAGE_DEFAULT_CONCURRENCY = int(os.getenv("IMAGE_MODEL_CONCURRENCY", "2"))
+# "модель:параллельно:в_минуту,..." например "dall-e-3:2:5,gpt-image-1:2:10"
+IMAGE_LIMITS = parse_model_limits(os.getenv("IMAGE_MODEL_LIMITS", ""))
+# обработчики определены ниже (раздел Core) — связываем лениво
+IMAGE_JOBS = GenQueue(DBI.db, lambda bot, job: _run_image_job(bot, job),
+                      on_fail=lambda bot, job, err: _image_job_failed(bot, job, err),
+                      workers=IMAGE_WORKERS)
 
 def _now(): return time.time()
 def _ymd(): return datetime.now(timezone.utc).strftime("%Y-%m-%d")
@@ -160,6 +235,10 @@ def last_history(chat_id:int, n:int=5):
     return DBI.all("SELECT ts,kind,prompt,response FROM history WHERE chat_id=? ORDER BY ts DESC LIMIT ?",
                    (chat_id, n))
 
+def _tokens(r)->Tuple[int,int]:
+    u=getattr(r,"usage",None)
+    return (getattr(u,"prompt_tokens",0) or 0, getattr(u,"completion_tokens",0) or 0) if u else (0,0)
+
 # ========= UI =========
 BTN_CHAT="💬 Болталка"
 BTN_IMG="🎨 Генерация фото"
@@ -198,6 +277,7 @@ PRICING_TEXT=(
 )
 
 # ========= Intent =========
+@timed("detect_intent")
 def detect_intent(text:str)->str:
     t=(text or "").lower()
     markers=[
@@ -222,12 +302,12 @@ def allow_text(chat_id:int)->Tuple[bool,str]:
 def allow_image(chat_id:int)->Tuple[bool,str,str]:
     plan,_=get_plan(chat_id)
     if plan==PLAN_FREE:
-        used=get_img_usage_today_free(chat_id)
+        used=get_img_usage_today_free(chat_id)+IMAGE_JOBS.pending(chat_id)
         if used>=FREE_DAILY_IMAGE:
             return False,"❌ Лимит бесплатных картинок на сегодня исчерпан. Оформите тариф в меню «💳 Тарифы».",PLAN_FREE
         return True,"",PLAN_FREE
     if plan==PLAN_STANDARD:
-        used=get_img_usage_month_std(chat_id)
+        used=get_img_usage_month_std(chat_id)+IMAGE_JOBS.pending(chat_id)
         if used>=STANDARD_IMG_MONTH:
             return False,"❌ Лимит картинок по «Стандарт» исчерпан за месяц. Обновите тариф.",PLAN_STANDARD
         return True,"",PLAN_STANDARD
@@ -242,19 +322,27 @@ async def handle_chat(update:Update, context:ContextTypes.DEFAULT_TYPE, text:str
     await context.bot.send_chat_action(chat_id, ChatAction.TYPING)
     msgs=[{"role":"system","content":"Ты дружелюбный, краткий и полезный помощник."},
           {"role":"user","content":text}]
+    plan=get_plan(chat_id)[0]
     client=_client()
-    out=None
-    for model in TEXT_PREFS:
-        try:
-            r=client.chat.completions.create(model=model, messages=msgs, temperature=0.6, timeout=OPENAI_TIMEOUT_S)
-            out=(r.choices[0].message.content or "").strip()
-            if out: break
-        except Exception:
-            continue
+    out=used=r=None
+    try:
+        async with SCHED.slot(plan):
+            t0=time.perf_counter()
+            with stage("model:text"):
+                for model in TEXT_PREFS:
+                    try:
+                        r=await _model_call(client.chat.completions.create, model=model, messages=msgs, temperature=0.6, timeout=OPENAI_TIMEOUT_S)
+                        out=(r.choices[0].message.content or "").strip()
+                        if out: used=model; break
+                    except Exception:
+                        continue
+            ANALYTICS.record("text", plan, used, time.perf_counter()-t0, bool(out), *_tokens(r))
+    except Overloaded:
+        await update.message.reply_text(BUSY_TEXT, reply_markup=KB); return
     if not out:
         await update.message.reply_text("Не удалось ответить. Попробуйте ещё раз.", reply_markup=KB); return
 
-    if get_plan(chat_id)[0]==PLAN_FREE: inc_text_usage(chat_id)
+    if plan==PLAN_FREE: inc_text_usage(chat_id)
     add_history(chat_id,"text",text,out)
     await update.message.reply_text(out, reply_markup=KB)
 
@@ -278,13 +366,22 @@ async def handle_image(update:Update, context:ContextTypes.DEFAULT_TYPE, text:st
     if not ok:
         await update.message.reply_text(warn, reply_markup=KB)
         return
+    # сама генерация — в фоне (IMAGE_JOBS), квота списывается только при успехе
+    job_id, pos = await IMAGE_JOBS.enqueue(chat_id, text.strip(), plan)
+    print(f"[IMG] job={job_id} queued pos={pos}")
+    await update.message.reply_text(f"🎨 Принято! Место в очереди: {pos}. Пришлю картинку, как будет готова.", reply_markup=KB)
 
-    await context.bot.send_chat_action(chat_id, ChatAction.UPLOAD_PHOTO)
-    client = _client()
-    prompt = text.strip()
+class ImageGenError(Exception):
+    """Ни одна image-модель не справилась; текст исключения — для пользователя."""
+
+def _img_limiter(model:str)->ModelLimiter:
+    if model not in IMAGE_LIMITS:
+        IMAGE_LIMITS[model] = ModelLimiter(IMAGE_DEFAULT_CONCURRENCY)
+    return IMAGE_LIMITS[model]
 
+async def _generate_image(prompt:str, plan:str)->Tuple[Optional[bytes], Optional[str], str]:
+    client = _client()
     errors = []
-    img_b = None
 
     # приоритет: ENV → дефолтный список
     prefs = []
@@ -302,46 +399,54 @@ async def handle_image(update:Update, context:ContextTypes.DEFAULT_TYPE, text:st
             if (m or "").lower() == "dall-e-3":
                 kwargs["quality"] = "standard"
             print(f"[IMG] try model={m} prompt={prompt[:80]!r}")
-            gen = client.images.generate(**kwargs)
-            img_b = None
-            try:
-                b64 = getattr(gen.data[0], "b64_json", None)
-                if b64:
-                    img_b = base64.b64decode(b64)
-                else:
-                    url = getattr(gen.data[0], "url", None)
-                    if url:
-                        import requests
-                        r = requests.get(url, timeout=60)
-                        r.raise_for_status()
-                        img_b = r.content
-                    else:
-                        raise ValueError("no b64_json or url in response")
-            except Exception as e2:
-                raise e2
+            # сначала лимит модели (может ждать rpm), слот планировщика — только на сам вызов
+            async with _img_limiter(m):
+                async with SCHED.slot(plan):
+                    gen = await _model_call(client.images.generate, **kwargs)
+            # bytes из b64_json, либо ссылка — её отдаём Telegram без скачивания
+            b64 = getattr(gen.data[0], "b64_json", None)
+            if b64:
+                print(f"[IMG] success model={m}")
+                return base64.b64decode(b64), None, m
+            img_url = getattr(gen.data[0], "url", None)
+            if not img_url:
+                raise ValueError("no b64_json or url in response")
             print(f"[IMG] success model={m}")
-            break
+            return None, img_url, m
+        except Overloaded:
+            raise
         except Exception as e:
             msg = f"{type(e).__name__}: {e}"
             print(f"[IMG-ERR] model={m} -> {msg}")
             errors.append((m, msg))
             continue
 
-    if not img_b:
-        human = "Не удалось сгенерировать изображение."
-        if errors:
-            _m, _e = errors[0]
-            _e = str(_e)
-            if len(_e) > 280:
-                _e = _e[:280] + "…"
-            human += f"\nПричина ({_m}): {_e}\n"
-            human += "Проверьте доступ к image‑моделям в OpenAI (billing/verification)."
-        await update.message.reply_text(human, reply_markup=KB)
-        return
-
-    bio = BytesIO(img_b)
-    bio.name = "image.png"
-    bio.seek(0)
+    human = "Не удалось сгенерировать изображение."
+    if errors:
+        _m, _e = errors[0]
+        _e = str(_e)
+        if len(_e) > 280:
+            _e = _e[:280] + "…"
+        human += f"\nПричина ({_m}): {_e}\n"
+        human += "Проверьте доступ к image‑моделям в OpenAI (billing/verification)."
+    raise ImageGenError(human)
+
+async def _run_image_job(bot, job:dict):
+    with trace("image_job", job=job["id"], chat_id=job["chat_id"]):
+        await _image_job(bot, job)
+
+async def _image_job(bot, job:dict):
+    chat_id, prompt, plan = job["chat_id"], job["prompt"], job["plan"]
+    await bot.send_chat_action(chat_id, ChatAction.UPLOAD_PHOTO)
+    t0 = time.perf_counter()
+    try:
+        with stage("model:image"):
+            img_b, img_url, model = await _generate_image(prompt, plan)
+    except ImageGenError:
+        ANALYTICS.record("image", plan, None, time.perf_counter() - t0, ok=False)
+        raise
+    ANALYTICS.record("image", plan, model, time.perf_counter() - t0)
+    await _send_image(bot, chat_id, img_b, img_url)
 
     if plan == PLAN_FREE:
         inc_img_usage_free(chat_id)
@@ -349,7 +454,32 @@ async def handle_image(update:Update, context:ContextTypes.DEFAULT_TYPE, text:st
         inc_img_usage_std(chat_id)
     add_history(chat_id, "image", prompt, "[image]")
 
-    await context.bot.send_photo(chat_id, photo=bio, caption="Готово ✅", reply_markup=KB)
+async def _image_job_failed(bot, job:dict, err:BaseException):
+    if isinstance(err, ImageGenError):
+        text = str(err)
+    elif isinstance(err, Overloaded):
+        text = BUSY_TEXT
+    else:
+        text = "Не удалось сгенерировать изображение. Попробуйте ещё раз."
+    await bot.send_message(job["chat_id"], text, reply_markup=KB)
+
+async def _send_image(bot, chat_id:int, img_b:Optional[bytes], img_url:Optional[str]):
+    """bytes уходят в send_photo без лишней копии в BytesIO; ссылку сначала
+       отдаём Telegram как есть, а если он не смог её забрать — качаем потоково."""
+    if img_b:
+        await bot.send_photo(chat_id, photo=InputFile(img_b, filename="image.png"), caption="Готово ✅", reply_markup=KB)
+        return
+    try:
+        await bot.send_photo(chat_id, photo=img_url, caption="Готово ✅", reply_markup=KB)
+        return
+    except Exception as e:
+        print(f"[IMG] send by url failed ({type(e).__name__}: {e}), downloading…")
+    path = await _download_to_tmp(img_url)
+    try:
+        with open(path, "rb") as f:
+            await bot.send_photo(chat_id, photo=f, caption="Готово ✅", reply_markup=KB)
+    finally:
+        os.unlink(path)
 
 async def on_voice(update:Update, context:ContextTypes.DEFAULT_TYPE):
     chat_id=update.effective_chat.id
@@ -357,19 +487,33 @@ async def on_voice(update:Update, context:ContextTypes.DEFAULT_TYPE):
     if not ok: await update.message.reply_text(warn, reply_markup=KB); return
     try:
         await context.bot.send_chat_action(chat_id, ChatAction.RECORD_VOICE)
-        file_id = (update.message.voice or update.message.audio).file_id
-        tg_file = await context.bot.get_file(file_id)
-        buf = BytesIO(); await tg_file.download_to_memory(out=buf); data = buf.getvalue()
-
-        text=None
-        for m in ("gpt-4o-mini-transcribe","whisper-1"):
-            try:
-                tmp=BytesIO(data); tmp.name="voice.ogg"
-                res=_client().audio.transcriptions.create(model=m, file=tmp)
-                text=(getattr(res,"text",None) or "").strip()
-                if text: break
-            except Exception:
-                continue
+        media = update.message.voice or update.message.audio
+        tg_file = await context.bot.get_file(media.file_id)
+        data = await tg_file.download_as_bytearray()
+
+        # тишина обрезается, 16 kHz mono opus, длинные записи — кусками (в пуле потоков)
+        with stage("audio_prep"):
+            parts = await audio_prep.prepare_async(data, getattr(media, "file_name", None) or "voice.ogg")
+        del data
+        if not parts:
+            await update.message.reply_text("Не слышу речи в сообщении 🤔", reply_markup=KB); return
+
+        text=used=None
+        plan=get_plan(chat_id)[0]
+        try:
+            async with SCHED.slot(plan):
+                t0=time.perf_counter()
+                sem=asyncio.Semaphore(VOICE_PARALLEL)  # слот один, а кусков может быть много
+                async def one(p):
+                    async with sem: return await _transcribe(p)
+                with stage("model:voice"):
+                    res=await asyncio.gather(*(one(p) for p in parts))
+                # кусок без текста — дыра в середине расшифровки: не склеиваем, считаем неудачей
+                text=" ".join(t for t,_ in res).strip() if all(t for t,_ in res) else ""
+                used=next((m for _,m in res if m), None)
+                ANALYTICS.record("voice", plan, used, time.perf_counter()-t0, bool(text))
+        except Overloaded:
+            await update.message.reply_text(BUSY_TEXT, reply_markup=KB); return
         if not text:
             await update.message.reply_text("Не удалось распознать голос.", reply_markup=KB); return
 
@@ -378,6 +522,18 @@ async def on_voice(update:Update, context:ContextTypes.DEFAULT_TYPE):
         tb=traceback.format_exc(limit=2)
         await update.message.reply_text(f"Ошибка распознавания: {e}\n{tb}", reply_markup=KB)
 
+async def _transcribe(part:Tuple[str,bytes])->Tuple[str,Optional[str]]:
+    """Один кусок: (имя, bytes) уходит в API как есть, без копии в BytesIO."""
+    for m in ("gpt-4o-mini-transcribe","whisper-1"):
+        try:
+            res=await _model_call(_client().audio.transcriptions.create, model=m, file=part)
+            text=(getattr(res,"text",None) or "").strip()
+            if text: return text, m
+        except Exception:
+            continue
+    return "", None
+
+@timed("synth_tts")
 async def synth_tts(text:str, chat_id:int)->str:
     """Генерим MP3 через OpenAI, затем пытаемся конвертировать в OGG/Opus.
        Если файл пустой/битый — фоллбэк на другую дорожку/формат."""
@@ -466,36 +622,49 @@ async def cmd_grant(update, context):
         await update.message.reply_text("Использование: /grant standard|premium <дней>"); return
     set_plan(update.effective_chat.id, args[1], int(args[2])); await update.message.reply_text("Тариф выдан ✅")
 
-import secrets, string
-def _gen_code(n=15):
-    alphabet=string.ascii_uppercase+string.digits
-    return "-".join("".join(secrets.choice(alphabet) for _ in range(5)) for __ in range(3))[:n+(n-1)//5]
-
-def _create_codes(plan:str, days:int, count:int=1):
-    codes=[]
-    for _ in range(count):
-        c=_gen_code(15)
-        DBI.exec("INSERT INTO redeem_codes(code,plan,days,used) VALUES(?,?,?,0)", (c,plan,days))
-        codes.append(c)
-    return codes
+GENREDEEM_MAX    = int(os.getenv("GENREDEEM_MAX", "100000"))
+GENREDEEM_INLINE = 20  # больше — отдаём CSV-файлом
 
 def _redeem(chat_id:int, code:str)->Tuple[bool,str]:
-    row=DBI.one("SELECT plan,days,used FROM redeem_codes WHERE code=?", (code,))
-    if not row: return False,"Код не найден."
-    plan,days,used=row
-    if used: return False,"Код уже использован."
-    set_plan(chat_id, plan, int(days or 30))
-    DBI.exec("UPDATE redeem_codes SET used=1 WHERE code=?", (code,))
+    status,row=redeem_codes.claim(DBI.db, code, chat_id)
+    if status=="missing": DBI.db.rollback(); return False,"Код не найден."
+    if status=="used":    DBI.db.rollback(); return False,"Код уже использован."
+    plan,days=row
+    try:
+        set_plan(chat_id, plan, days)  # коммитит и пометку кода
+    except Exception:
+        DBI.db.rollback(); raise
     return True,f"Тариф активирован: {plan} на {days} дн."
 
+async def _send_codes_csv(context, chat_id:int, batch:str)->int:
+    n,data=await asyncio.to_thread(redeem_codes.export_csv, DB_PATH, batch)
+    if n:
+        await context.bot.send_document(chat_id, document=InputFile(data, filename=f"codes_{batch}.csv"),
+                                        caption=f"Партия {batch}: {n} кодов")
+    return n
+
 async def cmd_genredeem(update, context):
     if not _is_admin(update): await update.message.reply_text("Недостаточно прав."); return
     args=(update.message.text or "").split()
     if len(args)<3 or args[1] not in (PLAN_STANDARD,PLAN_PREMIUM):
         await update.message.reply_text("Использование: /genredeem standard|premium <дней> [кол-во]"); return
     days=int(args[2]); count=int(args[3]) if len(args)>=4 else 1
-    codes=_create_codes(args[1], days, count)
-    await update.message.reply_text("Коды:\n"+"\n".join("- "+c for c in codes))
+    if not 1<=count<=GENREDEEM_MAX:
+        await update.message.reply_text(f"Кол-во: от 1 до {GENREDEEM_MAX}"); return
+    t0=time.perf_counter()
+    batch,codes=await asyncio.to_thread(redeem_codes.issue_codes, DB_PATH, args[1], days, count)
+    print(f"[REDEEM] batch={batch} count={len(codes)} in {time.perf_counter()-t0:.2f}s")
+    if len(codes)<=GENREDEEM_INLINE:
+        await update.message.reply_text(f"Партия {batch}\nКоды:\n"+"\n".join("- "+c for c in codes)); return
+    await _send_codes_csv(context, update.effective_chat.id, batch)
+
+async def cmd_exportcodes(update, context):
+    if not _is_admin(update): await update.message.reply_text("Недостаточно прав."); return
+    args=(update.message.text or "").split()
+    if len(args)!=2:
+        await update.message.reply_text("Использование: /exportcodes <партия>"); return
+    if not await _send_codes_csv(context, update.effective_chat.id, args[1]):
+        await update.message.reply_text("Партия не найдена.")
 
 async def cmd_redeem(update, context):
     args=(update.message.text or "").split()
@@ -504,6 +673,57 @@ async def cmd_redeem(update, context):
     ok,msg=_redeem(update.effective_chat.id, args[1].strip().upper())
     await update.message.reply_text(("✅ "+msg) if ok else ("❌ "+msg), reply_markup=KB)
 
+BCAST = Broadcaster(DBI.db, DB_PATH, rate=float(os.getenv("BROADCAST_RATE", "30")))
+
+async def cmd_broadcast(update, context):
+    if not _is_admin(update): await update.message.reply_text("Недостаточно прав."); return
+    parts=(update.message.text or "").split(None, 1)
+    if len(parts)<2 or not parts[1].strip():
+        await update.message.reply_text("Использование: /broadcast <текст>"); return
+    active=BCAST.active()
+    if active:
+        await update.message.reply_text(f"Уже идёт рассылка #{active[0]}. Остановить: /broadcaststop {active[0]}"); return
+    msg=await update.message.reply_text("📣 Рассылка запускается…")
+    bc_id=await BCAST.create(parts[1].strip(), update.effective_chat.id, msg.message_id)
+    BCAST.launch(bc_id)
+
+async def cmd_broadcaststop(update, context):
+    if not _is_admin(update): await update.message.reply_text("Недостаточно прав."); return
+    args=(update.message.text or "").split()
+    ids=[int(args[1])] if len(args)>=2 and args[1].isdigit() else BCAST.active()
+    if not ids: await update.message.reply_text("Активных рассылок нет."); return
+    for bc_id in ids: BCAST.cancel(bc_id)
+    await update.message.reply_text("Остановлено: "+", ".join(f"#{i}" for i in ids))
+
+KIND_LABELS={"text":"текст","image":"картинки","vision":"фото","voice":"голос"}
+
+def _stats_text(rep:dict)->str:
+    lines=[f"📊 Статистика с {rep['since']} (UTC)"]
+    day=None
+    for r in rep["daily"]:
+        if r["ymd"]!=day:
+            day=r["ymd"]; lines.append(f"\n{day}")
+        fail=r["events"]-r["ok"]
+        lines.append(f"  {KIND_LABELS.get(r['kind'],r['kind'])} · {r['plan']}: {r['ok']}"
+                     + (f" (+{fail} ошиб.)" if fail else "")
+                     + (f", токены {r['tokens_in']}/{r['tokens_out']}" if r["tokens_in"] or r["tokens_out"] else "")
+                     + f", ~{r['latency_avg_ms']} мс")
+    if rep["latency"]:
+        lines.append("\nЛатентность p50/p95:")
+        for k,v in rep["latency"].items():
+            lines.append(f"  {KIND_LABELS.get(k,k)}: ≤{v['p50_ms']} / ≤{v['p95_ms']} мс")
+    if rep["models"]:
+        lines.append("\nМодели: "+", ".join(f"{m['model']} {m['ok']}" for m in rep["models"]))
+    return "\n".join(lines) if rep["daily"] else "Данных пока нет."
+
+async def cmd_stats(update, context):
+    if not _is_admin(update): await update.message.reply_text("Недостаточно прав."); return
+    args=(update.message.text or "").split()
+    days=int(args[1]) if len(args)>=2 and args[1].isdigit() else 2
+    text=_stats_text(ANALYTICS.report(min(days, 90)))
+    for i in range(0, len(text), 4000):
+        await update.message.reply_text(text[i:i+4000])
+
 async def cmd_revoke(update, context):
     if not _is_admin(update): await update.message.reply_text("Недостаточно прав."); return
     args=(update.message.text or "").split()
@@ -570,24 +790,42 @@ async def on_photo(update, context):
                 {"type":"image_url","image_url":{"url":f"data:image/jpeg;base64,{b64}"}}
             ]
         }]
+        plan=get_plan(chat_id)[0]
         client=_client()
-        out=None
-        for model in ["gpt-4o","gpt-4.1","gpt-4o-mini"]:
-            try:
-                r=client.chat.completions.create(model=model, messages=msgs, temperature=0.2)
-                out=(r.choices[0].message.content or "").strip()
-                if out: break
-            except Exception:
-                continue
+        out=used=r=None
+        try:
+            async with SCHED.slot(plan):
+                t0=time.perf_counter()
+                with stage("model:vision"):
+                    for model in ["gpt-4o","gpt-4.1","gpt-4o-mini"]:
+                        try:
+                            r=await _model_call(client.chat.completions.create, model=model, messages=msgs, temperature=0.2)
+                            out=(r.choices[0].message.content or "").strip()
+                            if out: used=model; break
+                        except Exception:
+                            continue
+                ANALYTICS.record("vision", plan, used, time.perf_counter()-t0, bool(out), *_tokens(r))
+        except Overloaded:
+            await update.message.reply_text(BUSY_TEXT, reply_markup=KB); return
         if not out:
             await update.message.reply_text("Не удалось проанализировать фото.", reply_markup=KB); return
-        if get_plan(chat_id)[0]==PLAN_FREE: inc_text_usage(chat_id)
+        if plan==PLAN_FREE: inc_text_usage(chat_id)
         add_history(chat_id,"text","[photo]",out)
         await update.message.reply_text(out, reply_markup=KB)
     except Exception as e:
         tb=traceback.format_exc(limit=2)
         await update.message.reply_text(f"Ошибка анализа фото: {e}\n{tb}", reply_markup=KB)
 
+async def start_workers(bot):
+    await IMAGE_JOBS.start(bot)
+    await BCAST.start(bot)
+    await ANALYTICS.start()
+
+async def stop_workers():
+    await IMAGE_JOBS.stop()
+    await BCAST.stop()
+    await ANALYTICS.stop()
+
 def build_application():
     app=ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
     app.add_handler(CommandHandler("start",   cmd_start))
@@ -601,8 +839,12 @@ def build_application():
     # админ
     app.add_handler(CommandHandler("grant",   cmd_grant))
     app.add_handler(CommandHandler("genredeem", cmd_genredeem))
+    app.add_handler(CommandHandler("exportcodes", cmd_exportcodes))
     app.add_handler(CommandHandler("redeem",  cmd_redeem))
     app.add_handler(CommandHandler("revoke",  cmd_revoke))
+    app.add_handler(CommandHandler("broadcast", cmd_broadcast))
+    app.add_handler(CommandHandler("broadcaststop", cmd_broadcaststop))
+    app.add_handler(CommandHandler("stats", cmd_stats))
     # сервисная проверка images
     async def cmd_imgtest(update, context):
         await handle_image(update, context, "a cute orange cat sticker, simple and clean")
@@ -0,0 +1,276 @@
+import asyncio, heapq, sqlite3, time
+from typing import Any, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+# таблицы, где встречаются chat_id пользователей бота
+RECIPIENT_SOURCES = (("plans", ""), ("settings", ""), ("history", "DISTINCT "))
+# курсор «до первого chat_id»: у групп и каналов chat_id отрицательные
+START_CHAT_ID = -2**63
+
+
+class TokenBucket:
+    """Равномерный лимит `rate` в секунду (с запасом `burst`). pause() —
+    общий стоп на время flood-wait от Telegram."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.t = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+                self.t = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatThrottle:
+    """Не чаще одного сообщения в `interval` секунд в один чат."""
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.last: Dict[int, float] = {}
+
+    async def wait(self, chat_id: int):
+        last = self.last.get(chat_id)
+        if last is not None:
+            delay = last + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self.last[chat_id] = time.monotonic()
+
+    def prune(self):
+        edge = time.monotonic() - self.interval
+        self.last = {k: v for k, v in self.last.items() if v > edge}
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class Broadcaster:
+    """Рассылка всем chat_id из plans/settings/history. Получатели читаются
+    страницами по возрастанию chat_id, после каждой страницы прогресс
+    сохраняется в broadcasts — после рестарта рассылка продолжается с
+    последней сохранённой страницы (её часть может уйти повторно)."""
+
+    COLS = ("id", "text", "status", "last_chat_id", "sent", "failed", "blocked", "total",
+            "report_chat_id", "report_msg_id")
+
+    def __init__(self, db: sqlite3.Connection, db_path: str, rate: float = 30.0, per_chat_s: float = 1.0,
+                 page: int = 500, inflight: int = 50, report_every_s: float = 5.0, retries: int = 3):
+        self.db = db
+        self.db_path = db_path
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatThrottle(per_chat_s)
+        self.page = page
+        self.inflight = inflight
+        self.report_every_s = report_every_s
+        self.retries = retries
+        self.bot: Any = None
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.ensure()
+
+    def ensure(self):
+        self.db.execute(f"""CREATE TABLE IF NOT EXISTS broadcasts(
+            id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, status TEXT DEFAULT 'running',
+            last_chat_id INTEGER DEFAULT {START_CHAT_ID}, sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0, total INTEGER DEFAULT 0,
+            report_chat_id INTEGER, report_msg_id INTEGER, created_at REAL, updated_at REAL
+        )""")
+        self.db.commit()
+
+    # ---- получатели ----
+    def count_recipients(self) -> int:
+        """Полный UNION по таблицам — своё соединение, звать через asyncio.to_thread."""
+        q = " UNION ".join(f"SELECT chat_id FROM {t}" for t, _ in RECIPIENT_SOURCES)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            return int(conn.execute(f"SELECT COUNT(*) FROM ({q})").fetchone()[0])
+        finally:
+            conn.close()
+
+    def recipients_page(self, after: int) -> List[int]:
+        """Следующие `page` уникальных chat_id > after. Каждая таблица читается
+        по индексу своим keyset-запросом, результаты сливаются здесь."""
+        streams = [
+            [r[0] for r in self.db.execute(
+                f"SELECT {d}chat_id FROM {t} WHERE chat_id>? ORDER BY chat_id LIMIT ?", (after, self.page))]
+            for t, d in RECIPIENT_SOURCES
+        ]
+        out: List[int] = []
+        for cid in heapq.merge(*streams):
+            if not out or out[-1] != cid:
+                out.append(cid)
+                if len(out) >= self.page:
+                    break
+        return out
+
+    # ---- управление ----
+    def get(self, bc_id: int) -> Optional[Dict]:
+        row = self.db.execute(f"SELECT {','.join(self.COLS)} FROM broadcasts WHERE id=?", (bc_id,)).fetchone()
+        return dict(zip(self.COLS, row)) if row else None
+
+    def active(self) -> List[int]:
+        return [r[0] for r in self.db.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")]
+
+    async def create(self, text: str, report_chat_id: int, report_msg_id: Optional[int] = None) -> int:
+        total = await asyncio.to_thread(self.count_recipients)
+        now = time.time()
+        # курсор задаётся явно: в старых базах у колонки DEFAULT 0
+        cur = self.db.execute(
+            "INSERT INTO broadcasts(text,status,last_chat_id,total,report_chat_id,report_msg_id,created_at,updated_at) "
+            "VALUES(?,'running',?,?,?,?,?,?)", (text, START_CHAT_ID, total, report_chat_id, report_msg_id, now, now))
+        self.db.commit()
+        return cur.lastrowid
+
+    def launch(self, bc_id: int):
+        if bc_id not in self._tasks:
+            self._tasks[bc_id] = asyncio.create_task(self._run(bc_id))
+
+    def cancel(self, bc_id: int) -> bool:
+        self.db.execute("UPDATE broadcasts SET status='cancelled', updated_at=? WHERE id=? AND status='running'",
+                        (time.time(), bc_id))
+        self.db.commit()
+        t = self._tasks.pop(bc_id, None)
+        if t:
+            t.cancel()
+        return t is not None
+
+    async def start(self, bot):
+        self.bot = bot
+        for bc_id in self.active():
+            print(f"[BCAST] resume #{bc_id}")
+            self.launch(bc_id)
+
+    async def stop(self):
+        # статус остаётся running — при следующем старте продолжим с чекпоинта
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ---- отправка ----
+    async def _send_one(self, chat_id: int, text: str) -> str:
+        for attempt in range(self.retries):
+            await self.chats.wait(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                return "sent"
+            except RetryAfter as e:
+                wait = _seconds(e.retry_after) + 1
+                print(f"[BCAST] RetryAfter {wait:.0f}s")
+                self.bucket.pause(wait)
+            except Forbidden:
+                return "blocked"
+            except BadRequest:
+                return "failed"
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(1 + attempt)
+            except Exception as e:
+                print(f"[BCAST-ERR] chat={chat_id}: {type(e).__name__}: {e}")
+                return "failed"
+        return "failed"
+
+    def progress_text(self, bc: Dict, rate: float = 0.0) -> str:
+        done = bc["sent"] + bc["failed"] + bc["blocked"]
+        head = {"running": "📣 Рассылка", "done": "✅ Рассылка завершена", "cancelled": "⛔ Рассылка остановлена",
+                "failed": "⚠️ Рассылка прервана ошибкой"}
+        s = (f"{head.get(bc['status'], 'Рассылка')} #{bc['id']}: {done}/{bc['total']}\n"
+             f"доставлено {bc['sent']}, заблокировали {bc['blocked']}, ошибок {bc['failed']}")
+        if rate:
+            s += f"\nскорость {rate:.1f} сообщ./с"
+        return s
+
+    async def _report(self, bc: Dict, rate: float = 0.0):
+        if not bc.get("report_chat_id"):
+            return
+        text = self.progress_text(bc, rate)
+        try:
+            if bc.get("report_msg_id"):
+                await self.bot.edit_message_text(text, chat_id=bc["report_chat_id"], message_id=bc["report_msg_id"])
+            else:
+                await self.bot.send_message(bc["report_chat_id"], text)
+        except Exception as e:
+            if "not modified" not in str(e):
+                print(f"[BCAST] report failed: {type(e).__name__}: {e}")
+
+    async def _run(self, bc_id: int):
+        bc = self.get(bc_id)
+        sem = asyncio.Semaphore(self.inflight)
+        t0, n0 = time.monotonic(), 0
+
+        async def one(cid: int):
+            nonlocal n0
+            async with sem:
+                res = await self._send_one(cid, bc["text"])
+            bc[res] += 1
+            n0 += 1
+
+        async def reporter():
+            # по таймеру, а не по страницам: страница на 30/с уходит ~17 с
+            while True:
+                await asyncio.sleep(self.report_every_s)
+                await self._report(bc, n0 / max(time.monotonic() - t0, 1e-6))
+
+        rep = asyncio.create_task(reporter())
+        try:
+            while True:
+                page = self.recipients_page(bc["last_chat_id"])
+                if not page:
+                    break
+                await asyncio.gather(*(one(cid) for cid in page))
+                bc["last_chat_id"] = page[-1]
+                self.db.execute("UPDATE broadcasts SET last_chat_id=?, sent=?, failed=?, blocked=?, updated_at=? "
+                                "WHERE id=?", (bc["last_chat_id"], bc["sent"], bc["failed"], bc["blocked"],
+                                               time.time(), bc_id))
+                self.db.commit()
+                self.chats.prune()
+            rep.cancel()
+            bc["status"] = "done"
+            self.db.execute("UPDATE broadcasts SET status='done', updated_at=? WHERE id=?", (time.time(), bc_id))
+            self.db.commit()
+            elapsed = time.monotonic() - t0
+            print(f"[BCAST] #{bc_id} done: {n0} chats in {elapsed:.1f}s")
+            await self._report(bc, n0 / max(elapsed, 1e-6))
+        except asyncio.CancelledError:
+            cur = self.get(bc_id)
+            if cur and cur["status"] == "cancelled":
+                bc["status"] = "cancelled"
+                await self._report(bc)
+            raise
+        except Exception as e:
+            # иначе строка останется running и заблокирует следующие /broadcast
+            print(f"[BCAST-ERR] #{bc_id} aborted: {type(e).__name__}: {e}")
+            bc["status"] = "failed"
+            for attempt in range(3):
+                try:
+                    self.db.execute("UPDATE broadcasts SET status='failed', sent=?, failed=?, blocked=?, updated_at=? "
+                                    "WHERE id=? AND status='running'",
+                                    (bc["sent"], bc["failed"], bc["blocked"], time.time(), bc_id))
+                    self.db.commit()
+                    break
+                except sqlite3.Error as e2:
+                    print(f"[BCAST-ERR] #{bc_id} mark failed: {type(e2).__name__}: {e2}")
+                    await asyncio.sleep(1 + attempt)
+            await self._report(bc)
+        finally:
+            rep.cancel()
+            self._tasks.pop(bc_id, None)
@@ -0,0 +1,185 @@
+import asyncio, sqlite3, time, traceback
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+JobRunner = Callable[[Any, Dict], Awaitable[None]]
+JobFailHandler = Callable[[Any, Dict, BaseException], Awaitable[None]]
+
+
+class ModelLimiter:
+    """Лимит на одну модель: не больше `concurrency` вызовов одновременно
+    и не чаще `rpm` стартов в минуту (0 — без ограничения по частоте)."""
+
+    def __init__(self, concurrency: int = 2, rpm: int = 0):
+        self.sem = asyncio.Semaphore(max(1, concurrency))
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+
+    async def __aenter__(self):
+        await self.sem.acquire()
+        if self.interval:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+            if wait > 0:
+                try:
+                    await asyncio.sleep(wait)
+                except BaseException:
+                    self.sem.release()
+                    raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.sem.release()
+
+
+def parse_model_limits(spec: str) -> Dict[str, ModelLimiter]:
+    """'dall-e-3:2:5,gpt-image-1:1' -> {model: ModelLimiter(concurrency, rpm)}"""
+    out: Dict[str, ModelLimiter] = {}
+    for part in (spec or "").split(","):
+        bits = [b.strip() for b in part.split(":")]
+        if not bits[0]:
+            continue
+        conc = int(bits[1]) if len(bits) > 1 and bits[1] else 2
+        rpm = int(bits[2]) if len(bits) > 2 and bits[2] else 0
+        out[bits[0]] = ModelLimiter(conc, rpm)
+    return out
+
+
+class GenQueue:
+    """Очередь задач генерации в SQLite. Задача переживает рестарт: всё, что
+    было в статусе running, при старте возвращается в очередь (пока не
+    исчерпаны попытки). Обработку ведёт пул воркеров."""
+
+    COLS = ("id", "chat_id", "prompt", "plan", "status", "attempts", "created_at")
+
+    def __init__(self, db: sqlite3.Connection, run: JobRunner, on_fail: Optional[JobFailHandler] = None,
+                 table: str = "img_jobs", workers: int = 4, max_attempts: int = 3, poll_s: float = 5.0):
+        self.db = db
+        self.run = run
+        self.on_fail = on_fail
+        self.table = table
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.poll_s = poll_s
+        self._cond = asyncio.Condition()
+        self._tasks: List[asyncio.Task] = []
+        self._ctx: Any = None
+        self.ensure()
+
+    def ensure(self):
+        self.db.execute(f"""CREATE TABLE IF NOT EXISTS {self.table}(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER, prompt TEXT, plan TEXT,
+            status TEXT DEFAULT 'queued', attempts INTEGER DEFAULT 0,
+            created_at REAL, updated_at REAL, error TEXT
+        )""")
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_status ON {self.table}(status, id)")
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_chat ON {self.table}(chat_id, status)")
+        self.db.commit()
+
+    # ---- постановка / состояние ----
+    async def enqueue(self, chat_id: int, prompt: str, plan: str) -> Tuple[int, int]:
+        """Возвращает (id задачи, позиция в очереди начиная с 1)."""
+        now = time.time()
+        cur = self.db.execute(
+            f"INSERT INTO {self.table}(chat_id,prompt,plan,status,attempts,created_at,updated_at) "
+            f"VALUES(?,?,?,'queued',0,?,?)", (chat_id, prompt, plan, now, now))
+        self.db.commit()
+        job_id = cur.lastrowid
+        async with self._cond:
+            self._cond.notify()
+        return job_id, self.position(job_id)
+
+    def position(self, job_id: int) -> int:
+        row = self.db.execute(f"SELECT COUNT(*) FROM {self.table} WHERE status='queued' AND id<=?",
+                              (job_id,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def pending(self, chat_id: int) -> int:
+        """Сколько задач чата ещё не завершено — учитывается в лимитах до списания."""
+        row = self.db.execute(f"SELECT COUNT(*) FROM {self.table} WHERE chat_id=? AND status IN ('queued','running')",
+                              (chat_id,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _claim(self) -> Optional[Dict]:
+        # SELECT + UPDATE без await между ними — атомарно в рамках event loop
+        row = self.db.execute(
+            f"SELECT {','.join(self.COLS)} FROM {self.table} WHERE status='queued' ORDER BY id LIMIT 1").fetchone()
+        if not row:
+            return None
+        job = dict(zip(self.COLS, row))
+        job["attempts"] += 1
+        self.db.execute(f"UPDATE {self.table} SET status='running', attempts=?, updated_at=? WHERE id=?",
+                        (job["attempts"], time.time(), job["id"]))
+        self.db.commit()
+        return job
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None):
+        self.db.execute(f"UPDATE {self.table} SET status=?, error=?, updated_at=? WHERE id=?",
+                        (status, error, time.time(), job_id))
+        self.db.commit()
+
+    def _recover(self) -> List[Dict]:
+        """Незавершённые после рестарта задачи: вернуть в очередь или пометить failed."""
+        rows = self.db.execute(
+            f"SELECT {','.join(self.COLS)} FROM {self.table} WHERE status='running'").fetchall()
+        dead = [dict(zip(self.COLS, r)) for r in rows if r[5] >= self.max_attempts]
+        self.db.execute(f"UPDATE {self.table} SET status='queued', updated_at=? WHERE status='running' AND attempts<?",
+                        (time.time(), self.max_attempts))
+        for job in dead:
+            self.db.execute(f"UPDATE {self.table} SET status='failed', error='interrupted', updated_at=? WHERE id=?",
+                            (time.time(), job["id"]))
+        self.db.commit()
+        return dead
+
+    def purge(self, older_than_s: float = 7 * 86400):
+        self.db.execute(f"DELETE FROM {self.table} WHERE status IN ('done','failed') AND updated_at<?",
+                        (time.time() - older_than_s,))
+        self.db.commit()
+
+    # ---- воркеры ----
+    async def start(self, ctx: Any = None):
+        """ctx (обычно bot) передаётся в run/on_fail каждой задачи."""
+        if self._tasks:
+            return
+        self._ctx = ctx
+        self.purge()
+        for job in self._recover():
+            await self._fail(job, RuntimeError("interrupted"))
+        requeued = self.db.execute(f"SELECT COUNT(*) FROM {self.table} WHERE status='queued'").fetchone()[0]
+        print(f"[QUEUE] {self.table}: {self.workers} workers, {requeued} queued")
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        # running-задачи остаются в БД как running и подхватятся при следующем старте
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _fail(self, job: Dict, err: BaseException):
+        if self.on_fail:
+            try:
+                await self.on_fail(self._ctx, job, err)
+            except Exception as e:
+                print(f"[QUEUE-ERR] on_fail job={job['id']}: {type(e).__name__}: {e}")
+
+    async def _worker(self, n: int):
+        while True:
+            job = self._claim()
+            if job is None:
+                async with self._cond:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), self.poll_s)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            try:
+                await self.run(self._ctx, job)
+                self._finish(job["id"], "done")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[QUEUE-ERR] job={job['id']} worker={n}: {type(e).__name__}: {e}\n{traceback.format_exc(limit=2)}")
+                self._finish(job["id"], "failed", f"{type(e).__name__}: {e}"[:500])
+                await self._fail(job, e)
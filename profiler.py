@@ -0,0 +1,216 @@
+import asyncio, os, sys, threading, time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Deque, Dict, List, Optional
+
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "100"))
+
+
+def _frame_stack(frame) -> List[str]:
+    out = []
+    while frame is not None:
+        code = frame.f_code
+        out.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    out.reverse()
+    return out
+
+
+# ========= сэмплирующий профайлер =========
+_sampling = threading.Lock()
+
+
+def sample(seconds: float, interval_s: float = 0.005) -> str:
+    """Снимает стеки всех потоков каждые interval_s в течение seconds.
+    Результат — collapsed stacks ("поток;файл:функция;... N"), формат
+    flamegraph.pl / speedscope. Блокирует вызывающий поток — звать через to_thread."""
+    if not _sampling.acquire(blocking=False):
+        raise RuntimeError("profiler already running")
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts: Counter = Counter()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                counts[";".join([names.get(tid, str(tid)), *_frame_stack(frame)])] += 1
+            time.sleep(interval_s)
+            if len(names) != threading.active_count():
+                names = {t.ident: t.name for t in threading.enumerate()}
+        return "\n".join(f"{k} {v}" for k, v in counts.most_common()) + "\n"
+    finally:
+        _sampling.release()
+
+
+# ========= тайминги этапов обработки апдейта =========
+class Trace:
+    __slots__ = ("name", "info", "t0", "total_ms", "stages")
+
+    def __init__(self, name: str, info: Optional[Dict] = None):
+        self.name = name
+        self.info = info or {}
+        self.t0 = time.perf_counter()
+        self.total_ms = 0.0
+        self.stages: Dict[str, List[float]] = {}  # этап -> [мс, вызовов]
+
+    def add(self, stage: str, ms: float):
+        s = self.stages.get(stage)
+        if s is None:
+            self.stages[stage] = [ms, 1]
+        else:
+            s[0] += ms
+            s[1] += 1
+
+    def as_dict(self) -> Dict:
+        return {"name": self.name, **self.info, "total_ms": round(self.total_ms, 1),
+                "at": round(time.time() - self.total_ms / 1000, 3),
+                "stages": {k: {"ms": round(v[0], 1), "calls": v[1]}
+                           for k, v in sorted(self.stages.items(), key=lambda kv: -kv[1][0])}}
+
+
+_CUR: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+class SlowLog:
+    """Кольцевой буфер последних апдейтов медленнее threshold_ms."""
+
+    def __init__(self, size: int = 50, threshold_ms: float = SLOW_UPDATE_MS):
+        self.threshold_ms = threshold_ms
+        self.items: Deque[Dict] = deque(maxlen=size)
+        self.seen = 0
+
+    def offer(self, tr: Trace):
+        self.seen += 1
+        if tr.total_ms >= self.threshold_ms:
+            self.items.append(tr.as_dict())
+
+    def report(self) -> Dict:
+        return {"threshold_ms": self.threshold_ms, "seen": self.seen,
+                "slowest": sorted(self.items, key=lambda d: -d["total_ms"])}
+
+
+SLOW = SlowLog()
+
+
+@contextmanager
+def trace(name: str, **info):
+    """Открывает трассу на время обработки (апдейта, фоновой задачи)."""
+    tr = Trace(name, info)
+    tok = _CUR.set(tr)
+    try:
+        yield tr
+    finally:
+        _CUR.reset(tok)
+        tr.total_ms = (time.perf_counter() - tr.t0) * 1000
+        SLOW.offer(tr)
+
+
+@contextmanager
+def stage(name: str):
+    """Время этапа в текущей трассе; вне трассы — почти бесплатно."""
+    tr = _CUR.get()
+    if tr is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        tr.add(name, (time.perf_counter() - t0) * 1000)
+
+
+def timed(name: str):
+    """Декоратор stage() для обычных и async-функций."""
+    def deco(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def aw(*a, **kw):
+                with stage(name):
+                    return await fn(*a, **kw)
+            return aw
+
+        @wraps(fn)
+        def w(*a, **kw):
+            with stage(name):
+                return fn(*a, **kw)
+        return w
+    return deco
+
+
+# ========= лаг event loop =========
+class LoopMonitor:
+    """Задача в loop отмечается каждые interval_s и меряет опоздание своего
+    пробуждения (лаг). Сторожевой поток, увидев, что отметки нет дольше
+    stall_ms, снимает стек потока loop — это и есть блокирующий вызов."""
+
+    def __init__(self, interval_s: float = 0.05, stall_ms: float = LOOP_STALL_MS, keep: int = 50):
+        self.interval_s = interval_s
+        self.stall_ms = stall_ms
+        self.lags: Deque[float] = deque(maxlen=1200)  # ~1 мин истории
+        self.stalls: Deque[Dict] = deque(maxlen=keep)
+        self.beat = time.monotonic()
+        self._loop_tid: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    async def _tick(self):
+        while True:
+            t = time.monotonic()
+            await asyncio.sleep(self.interval_s)
+            now = time.monotonic()
+            self.lags.append(max(0.0, (now - t - self.interval_s) * 1000))
+            self.beat = now
+
+    def _watch(self):
+        current: Optional[Dict] = None
+        while not self._stop.wait(self.interval_s / 2):
+            behind = (time.monotonic() - self.beat) * 1000
+            if behind < self.stall_ms:
+                current = None
+                continue
+            frame = sys._current_frames().get(self._loop_tid)
+            stack = ";".join(_frame_stack(frame)) if frame is not None else ""
+            if current is None:
+                current = {"at": round(time.time() - behind / 1000, 3), "blocked_ms": round(behind),
+                           "stack": stack}
+                self.stalls.append(current)
+                print(f"[LOOP] event loop blocked >{self.stall_ms:.0f}ms: {stack.rsplit(';', 3)[-3:]}")
+            else:
+                current["blocked_ms"] = round(behind)
+
+    async def start(self):
+        if self._task:
+            return
+        self._loop_tid = threading.get_ident()
+        self.beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._tick())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def report(self) -> Dict:
+        xs = sorted(self.lags)
+        n = len(xs)
+        return {
+            "interval_ms": self.interval_s * 1000, "stall_ms": self.stall_ms,
+            "lag_p50_ms": round(xs[n // 2], 2) if n else 0.0,
+            "lag_p99_ms": round(xs[min(n - 1, int(n * 0.99))], 2) if n else 0.0,
+            "lag_max_ms": round(xs[-1], 2) if n else 0.0,
+            "stalls": list(self.stalls)[::-1],
+        }
+
+
+LOOP = LoopMonitor()
@@ -1,15 +1,114 @@
-import os, json, uuid
-from typing import List, Dict, Tuple
+import os, json, uuid, threading
+from typing import Dict, List, Optional, Tuple
 import numpy as np
 
+QUANTS = ("f32", "f16", "int8")
+BLOCK = 4096  # строк за один матвектор — ограничивает временную float32-копию
+
+
+def _atomic_write(path: str, data: str):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def quantize(vecs: np.ndarray, quant: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Строки нормируются (косинус = скалярное произведение), затем
+    f16 — простое приведение, int8 — симметрично, свой масштаб на вектор."""
+    v = np.asarray(vecs, dtype=np.float32)
+    v = v / np.maximum(np.linalg.norm(v, axis=1, keepdims=True), 1e-12)
+    if quant == "f32":
+        return v, None
+    if quant == "f16":
+        return v.astype(np.float16), None
+    scale = np.maximum(np.abs(v).max(axis=1), 1e-12) / 127.0
+    q = np.clip(np.rint(v / scale[:, None]), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+class _Segment:
+    """Неизменяемый сегмент: seg.vec.npy (+ seg.scale.npy для int8),
+    seg.meta.jsonl с текстами, seg.off.npy — смещения строк в meta,
+    seg.json — заголовок (seq, число строк, source_id по диапазонам строк)."""
+
+    def __init__(self, base: str, name: str):
+        self.base, self.name = base, name
+        p = os.path.join(base, name)
+        with open(p + ".json", "r", encoding="utf-8") as f:
+            self.head = json.load(f)
+        self.seq = int(self.head["seq"])
+        self.vec = np.load(p + ".vec.npy", mmap_mode="r")
+        self.scale = np.load(p + ".scale.npy") if os.path.exists(p + ".scale.npy") else None
+        self.off = np.load(p + ".off.npy")
+        self.meta_path = p + ".meta.jsonl"
+
+    def dead_mask(self, tombs: Dict[str, int]) -> Optional[np.ndarray]:
+        mask = None
+        for sid, start, end in self.head["runs"]:
+            t = tombs.get(sid)
+            if t is not None and self.seq <= t:
+                if mask is None:
+                    mask = np.zeros(len(self.off), dtype=bool)
+                mask[start:end] = True
+        return mask
+
+    def scores(self, q: np.ndarray) -> np.ndarray:
+        out = np.empty(len(self.off), dtype=np.float32)
+        for i in range(0, len(out), BLOCK):
+            out[i:i + BLOCK] = np.asarray(self.vec[i:i + BLOCK], dtype=np.float32) @ q
+        if self.scale is not None:
+            out *= self.scale
+        return out
+
+    def records(self, rows: List[int]) -> List[Dict]:
+        out = []
+        with open(self.meta_path, "rb") as f:
+            for r in rows:
+                f.seek(int(self.off[r]))
+                out.append(json.loads(f.readline()))
+        return out
+
+    def files(self) -> List[str]:
+        p = os.path.join(self.base, self.name)
+        return [p + s for s in (".json", ".vec.npy", ".scale.npy", ".off.npy", ".meta.jsonl") if os.path.exists(p + s)]
+
+
 class RagStore:
-    def __init__(self, base_dir: str):
+    """Векторное хранилище из неизменяемых сегментов. Эмбеддинги хранятся
+    в float32 / float16 / int8 (поиск идёт прямо по квантованным данным),
+    удаление источника — надгробие в tombstones.json, compact() переписывает
+    сегменты без удалённого, не блокируя поиск. По умолчанию f32 (без потерь);
+    f16/int8 — только явно (quant= или RAG_QUANT). Старый index.jsonl при
+    первом открытии переносится в сегмент в текущем quant."""
+
+    def __init__(self, base_dir: str, quant: Optional[str] = None):
         self.base_dir = base_dir
         os.makedirs(self.base_dir, exist_ok=True)
         self.index_path = os.path.join(self.base_dir, "index.jsonl")
-        if not os.path.exists(self.index_path):
-            open(self.index_path, "w").close()
+        self.manifest_path = os.path.join(self.base_dir, "manifest.json")
+        self.tombs_path = os.path.join(self.base_dir, "tombstones.json")
+        self._lock = threading.Lock()          # манифест/надгробия — короткие секции
+        self._compact_lock = threading.Lock()  # одна компакция за раз
+        self._segs: Dict[str, _Segment] = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"quant": quant or os.getenv("RAG_QUANT", "f32"), "next_seq": 1, "segments": []}
+        if quant and quant != self.manifest["quant"]:
+            self.manifest["quant"] = quant  # новые сегменты — в новом формате, старые перепишет compact()
+        if self.manifest["quant"] not in QUANTS:
+            raise ValueError(f"quant must be one of {QUANTS}")
+        self.tombs: Dict[str, int] = {}
+        if os.path.exists(self.tombs_path):
+            with open(self.tombs_path, "r", encoding="utf-8") as f:
+                self.tombs = json.load(f)
+        self._migrate_legacy()
 
+    # ---- legacy ----
     def _iter_records(self):
         if not os.path.exists(self.index_path):
             return
@@ -20,19 +119,174 @@ class RagStore:
                     continue
                 yield json.loads(line)
 
+    def _migrate_legacy(self):
+        if not os.path.exists(self.index_path) or self.manifest["segments"]:
+            return
+        by_src: Dict[str, List[Dict]] = {}
+        for rec in self._iter_records():
+            by_src.setdefault(rec["source_id"], []).append(rec)
+        recs = [r for rs in by_src.values() for r in rs]
+        if recs:
+            self._write_segment([{"id": r["id"], "source_id": r["source_id"], "text": r["text"]} for r in recs],
+                                np.array([r["embedding"] for r in recs], dtype=np.float32))
+        os.replace(self.index_path, self.index_path + ".migrated")
+
+    # ---- запись ----
+    def _save_manifest(self):
+        _atomic_write(self.manifest_path, json.dumps(self.manifest))
+
+    def _write_segment(self, metas: List[Dict], vecs: np.ndarray, seq: Optional[int] = None,
+                       publish: bool = True) -> str:
+        """Пишет сегмент на диск и (если publish) атомарно добавляет в манифест."""
+        quant = self.manifest["quant"]
+        with self._lock:
+            if seq is None:
+                seq = self.manifest["next_seq"]
+                self.manifest["next_seq"] += 1
+            name = f"seg_{uuid.uuid4().hex[:12]}"
+        p = os.path.join(self.base_dir, name)
+        q, scale = quantize(vecs, quant)
+        np.save(p + ".vec.npy", q)
+        if scale is not None:
+            np.save(p + ".scale.npy", scale)
+        offs, runs, pos = [], [], 0
+        with open(p + ".meta.jsonl", "wb") as f:
+            for i, m in enumerate(metas):
+                line = (json.dumps(m, ensure_ascii=False) + "\n").encode("utf-8")
+                offs.append(pos)
+                pos += len(line)
+                f.write(line)
+                if runs and runs[-1][0] == m["source_id"] and runs[-1][2] == i:
+                    runs[-1][2] = i + 1
+                else:
+                    runs.append([m["source_id"], i, i + 1])
+        np.save(p + ".off.npy", np.array(offs, dtype=np.int64))
+        _atomic_write(p + ".json", json.dumps({"seq": seq, "count": len(metas), "quant": quant,
+                                               "dim": int(vecs.shape[1]), "runs": runs}))
+        if publish:
+            with self._lock:
+                self.manifest["segments"].append(name)
+                self._save_manifest()
+        return name
+
     def add_chunks(self, source_id: str, chunks: List[str], embeddings: List[List[float]]):
-        with open(self.index_path, "a", encoding="utf-8") as f:
-            for text, emb in zip(chunks, embeddings):
-                rec = {"id": str(uuid.uuid4()), "source_id": source_id, "text": text, "embedding": emb}
-                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        n = min(len(chunks), len(embeddings))  # как zip(): лишние чанки/эмбеддинги отбрасываются
+        metas = [{"id": str(uuid.uuid4()), "source_id": source_id, "text": t} for t in chunks[:n]]
+        if metas:
+            self._write_segment(metas, np.asarray(embeddings[:n], dtype=np.float32))
+
+    def delete_source(self, source_id: str):
+        """Надгробие: скрывает все уже добавленные чанки источника
+        (добавленные позже — видны). Место освобождает compact()."""
+        with self._lock:
+            self.tombs[source_id] = self.manifest["next_seq"] - 1
+            _atomic_write(self.tombs_path, json.dumps(self.tombs))
+
+    # ---- чтение ----
+    def _seg(self, name: str) -> _Segment:
+        seg = self._segs.get(name)
+        if seg is None:
+            seg = self._segs[name] = _Segment(self.base_dir, name)
+        return seg
+
+    def _snapshot(self) -> Tuple[List[str], Dict[str, int]]:
+        with self._lock:
+            return list(self.manifest["segments"]), dict(self.tombs)
 
     def search(self, query_embedding: List[float], k: int = 5) -> List[Dict]:
-        q = np.array(query_embedding, dtype=np.float32)
-        results: List[Tuple[float, Dict]] = []
-        for rec in self._iter_records():
-            v = np.array(rec["embedding"], dtype=np.float32)
-            denom = (np.linalg.norm(q) * np.linalg.norm(v)) or 1e-12
-            sim = float(np.dot(q, v) / denom)
-            results.append((sim, rec))
-        results.sort(key=lambda x: x[0], reverse=True)
-        return [r[1] for r in results[:k]]
+        q = np.asarray(query_embedding, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1e-12)
+        for attempt in range(2):
+            names, tombs = self._snapshot()
+            try:
+                best: List[Tuple[float, str, int]] = []
+                for name in names:
+                    seg = self._seg(name)
+                    if not len(seg.off):
+                        continue
+                    s = seg.scores(q)
+                    dead = seg.dead_mask(tombs)
+                    if dead is not None:
+                        s[dead] = -np.inf
+                    top = np.argpartition(-s, min(k, len(s)) - 1)[:k] if len(s) > k else np.arange(len(s))
+                    best.extend((float(s[i]), name, int(i)) for i in top if np.isfinite(s[i]))
+                best.sort(key=lambda x: x[0], reverse=True)
+                out = []
+                for score, name, row in best[:k]:
+                    rec = self._seg(name).records([row])[0]
+                    rec["score"] = score
+                    out.append(rec)
+                return out
+            except FileNotFoundError:
+                if attempt:
+                    raise  # сегмент удалён компакцией между снимком и чтением — берём свежий манифест
+        return []
+
+    # ---- обслуживание ----
+    def stats(self) -> Dict:
+        names, tombs = self._snapshot()
+        rows = dead = disk = ram = 0
+        for name in names:
+            seg = self._seg(name)
+            rows += len(seg.off)
+            m = seg.dead_mask(tombs)
+            dead += int(m.sum()) if m is not None else 0
+            disk += sum(os.path.getsize(p) for p in seg.files())
+            ram += seg.vec.nbytes + (seg.scale.nbytes if seg.scale is not None else 0) + seg.off.nbytes
+        return {"quant": self.manifest["quant"], "segments": len(names), "rows": rows, "dead": dead,
+                "disk_bytes": disk, "vector_bytes": ram}
+
+    def compact(self, max_rows: int = 200000) -> Dict:
+        """Сливает сегменты в крупные, выкидывая скрытые надгробиями строки и
+        перекодируя в текущий quant. Поиск в это время идёт по старым сегментам;
+        новые — подменяют их атомарной записью манифеста."""
+        with self._compact_lock:
+            names, tombs = self._snapshot()
+            if not names:
+                return self.stats()
+            segs = [self._seg(n) for n in names]
+            seq = max(s.seq for s in segs)
+            metas: List[Dict] = []
+            vecs: List[np.ndarray] = []
+            new_names: List[str] = []
+
+            def flush():
+                if metas:
+                    new_names.append(self._write_segment(list(metas), np.concatenate(vecs), seq, publish=False))
+                    metas.clear(); vecs.clear()
+
+            for seg in segs:
+                dead = seg.dead_mask(tombs)
+                alive = np.flatnonzero(~dead) if dead is not None else np.arange(len(seg.off))
+                if len(alive):
+                    v = np.asarray(seg.vec, dtype=np.float32)[alive]
+                    if seg.scale is not None:
+                        v = v * seg.scale[alive, None]
+                    vecs.append(v)
+                    metas.extend(seg.records(alive.tolist()))
+                if len(metas) >= max_rows:
+                    flush()
+            flush()
+            # подмена одним шагом: сегменты, добавленные во время компакции, сохраняются
+            with self._lock:
+                added = [s for s in self.manifest["segments"] if s not in names]
+                self.manifest["segments"] = new_names + added
+                # надгробия из снимка отработаны; удалённые повторно во время компакции — остаются
+                for sid, t in tombs.items():
+                    if self.tombs.get(sid) == t:
+                        del self.tombs[sid]
+                self._save_manifest()
+                _atomic_write(self.tombs_path, json.dumps(self.tombs))
+            for seg in segs:
+                self._segs.pop(seg.name, None)
+                for p in seg.files():
+                    try:
+                        os.remove(p)
+                    except OSError:
+                        pass
+            return self.stats()
+
+    def compact_async(self) -> threading.Thread:
+        t = threading.Thread(target=self.compact, name="rag-compact", daemon=True)
+        t.start()
+        return t
@@ -0,0 +1,103 @@
+import csv, io, secrets, sqlite3, string, time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+ALPHABET = string.ascii_uppercase + string.digits
+CHUNK = 5000
+
+
+def gen_code(groups: int = 3, size: int = 5) -> str:
+    """XXXXX-XXXXX-XXXXX: 36^15 ≈ 2^77 вариантов. Одно обращение к CSPRNG
+    на код вместо 15 secrets.choice — заметно при выпуске десятков тысяч."""
+    n = secrets.randbelow(36 ** (groups * size))
+    chars = []
+    for _ in range(groups * size):
+        n, r = divmod(n, 36)
+        chars.append(ALPHABET[r])
+    return "-".join("".join(chars[i:i + size]) for i in range(0, groups * size, size))
+
+
+def gen_batch_id() -> str:
+    return datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S") + "-" + secrets.token_hex(2)
+
+
+def ensure(db: sqlite3.Connection):
+    """Доп. колонки для партий и учёта активаций (старые базы мигрируются на месте)."""
+    cols = {r[1] for r in db.execute("PRAGMA table_info(redeem_codes)")}
+    for name, decl in (("batch", "TEXT"), ("created_at", "REAL"), ("used_by", "INTEGER"), ("used_at", "REAL")):
+        if name not in cols:
+            db.execute(f"ALTER TABLE redeem_codes ADD COLUMN {name} {decl}")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_redeem_batch ON redeem_codes(batch)")
+    db.commit()
+
+
+def issue_codes(db_path: str, plan: str, days: int, count: int,
+                batch: Optional[str] = None) -> Tuple[str, List[str]]:
+    """Выпускает партию кодов одной транзакцией (executemany кусками по CHUNK).
+    Коллизии с уже существующими кодами отсекаются INSERT OR IGNORE и
+    догенерируются. Своё соединение — можно звать из asyncio.to_thread."""
+    batch = batch or gen_batch_id()
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        issued: List[str] = []
+        seen = set()
+        while len(issued) < count:
+            need = min(CHUNK, count - len(issued))
+            fresh = []
+            while len(fresh) < need:
+                c = gen_code()
+                if c not in seen:
+                    seen.add(c)
+                    fresh.append(c)
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO redeem_codes(code,plan,days,used,batch,created_at) VALUES(?,?,?,0,?,?)",
+                [(c, plan, days, batch, now) for c in fresh])
+            if conn.total_changes - before == len(fresh):
+                issued.extend(fresh)
+            else:
+                # редкий случай: часть кодов уже была в базе — оставляем только вставленные нами
+                ph = ",".join("?" * len(fresh))
+                mine = {r[0] for r in conn.execute(
+                    f"SELECT code FROM redeem_codes WHERE batch=? AND code IN ({ph})", (batch, *fresh))}
+                issued.extend(c for c in fresh if c in mine)
+        conn.commit()
+        return batch, issued
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def claim(db: sqlite3.Connection, code: str, chat_id: int) -> Tuple[str, Optional[Tuple[str, int]]]:
+    """Атомарно помечает код использованным (условный UPDATE ... AND used=0):
+    из двух одновременных активаций успешна ровно одна. Коммит — на вызывающем.
+    Возвращает ("ok", (plan, days)) | ("used", None) | ("missing", None)."""
+    cur = db.execute("UPDATE redeem_codes SET used=1, used_by=?, used_at=? WHERE code=? AND used=0",
+                     (chat_id, time.time(), code))
+    if cur.rowcount == 1:
+        plan, days = db.execute("SELECT plan, days FROM redeem_codes WHERE code=?", (code,)).fetchone()
+        return "ok", (plan, int(days or 30))
+    row = db.execute("SELECT 1 FROM redeem_codes WHERE code=?", (code,)).fetchone()
+    return ("used" if row else "missing"), None
+
+
+def export_csv(db_path: str, batch: str) -> Tuple[int, bytes]:
+    """CSV партии: (кол-во строк, содержимое в utf-8)."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        w.writerow(["code", "plan", "days", "used", "used_by", "used_at"])
+        n = 0
+        for code, plan, days, used, used_by, used_at in conn.execute(
+                "SELECT code,plan,days,used,used_by,used_at FROM redeem_codes WHERE batch=? ORDER BY rowid", (batch,)):
+            ts = datetime.fromtimestamp(used_at, tz=timezone.utc).isoformat(timespec="seconds") if used_at else ""
+            w.writerow([code, plan, days, used, used_by or "", ts])
+            n += 1
+        return n, buf.getvalue().encode("utf-8")
+    finally:
+        conn.close()
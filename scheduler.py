@@ -0,0 +1,149 @@
+import asyncio, time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional
+
+
+class Overloaded(Exception):
+    """Запрос снят с очереди: не дождался слота до своего дедлайна."""
+
+
+class _Waiter:
+    __slots__ = ("plan", "fut", "t0")
+
+    def __init__(self, plan: str, fut: asyncio.Future):
+        self.plan = plan
+        self.fut = fut
+        self.t0 = time.monotonic()
+
+
+class FairScheduler:
+    """Общий бюджет параллельных вызовов моделей, поделённый между тарифами
+    по весам (stride scheduling: у каждого тарифа виртуальное время, слот
+    получает очередь с наименьшим). Ожидающий дольше `starvation_s` получает
+    слот вне очереди. Для тарифов из `deadlines` запрос снимается, если не
+    дождался слота за указанное время."""
+
+    def __init__(self, capacity: int, weights: Dict[str, float],
+                 deadlines: Optional[Dict[str, float]] = None,
+                 starvation_s: float = 30.0, window: int = 1000):
+        self.capacity = max(1, capacity)
+        self.weights = {p: max(float(w), 1e-6) for p, w in weights.items()}
+        self.deadlines = deadlines or {}
+        self.starvation_s = starvation_s
+        self.window = window
+        self.in_use = 0
+        self.queues: Dict[str, Deque[_Waiter]] = {p: deque() for p in self.weights}
+        self.vtime: Dict[str, float] = {p: 0.0 for p in self.weights}
+        self._vnow = 0.0
+        self.waits: Dict[str, Deque[float]] = {p: deque(maxlen=window) for p in self.weights}
+        self.counters: Dict[str, Dict[str, int]] = {p: {"granted": 0, "shed": 0} for p in self.weights}
+
+    def _q(self, plan: str) -> Deque[_Waiter]:
+        if plan not in self.queues:
+            self.weights[plan] = 1.0
+            self.queues[plan] = deque()
+            self.vtime[plan] = self._vnow
+            self.waits[plan] = deque(maxlen=self.window)
+            self.counters[plan] = {"granted": 0, "shed": 0}
+        return self.queues[plan]
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    @asynccontextmanager
+    async def slot(self, plan: str):
+        q = self._q(plan)
+        if self.in_use < self.capacity and not self.queued():
+            self.in_use += 1
+            self._account(plan, 0.0)
+        else:
+            if not q:
+                # очередь просыпается — не даём ей накопленный за простой кредит
+                self.vtime[plan] = max(self.vtime[plan], self._vnow)
+            w = _Waiter(plan, asyncio.get_running_loop().create_future())
+            q.append(w)
+            try:
+                await asyncio.wait_for(asyncio.shield(w.fut), self.deadlines.get(plan))
+            except BaseException as e:
+                granted = w.fut.done() and not w.fut.cancelled()
+                self._drop(w)
+                if isinstance(e, asyncio.TimeoutError):
+                    if not granted:
+                        self.counters[plan]["shed"] += 1
+                        raise Overloaded(plan)
+                    # слот выдан в момент таймаута — пользуемся им
+                else:
+                    if granted:
+                        self._release()
+                    raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _drop(self, w: _Waiter):
+        try:
+            self.queues[w.plan].remove(w)
+        except ValueError:
+            pass
+        if not w.fut.done():
+            w.fut.cancel()
+
+    def _account(self, plan: str, waited: float):
+        self.waits[plan].append(waited)
+        self.counters[plan]["granted"] += 1
+
+    def _release(self):
+        self.in_use -= 1
+        self._dispatch()
+
+    def _pick(self) -> Optional[str]:
+        now = time.monotonic()
+        ready = [p for p, q in self.queues.items() if q]
+        if not ready:
+            return None
+        oldest = min(ready, key=lambda p: self.queues[p][0].t0)
+        if now - self.queues[oldest][0].t0 >= self.starvation_s:
+            return oldest
+        return min(ready, key=lambda p: self.vtime[p])
+
+    def _dispatch(self):
+        while self.in_use < self.capacity:
+            plan = self._pick()
+            if plan is None:
+                return
+            w = self.queues[plan].popleft()
+            if w.fut.done():
+                continue
+            self._vnow = self.vtime[plan]
+            self.vtime[plan] += 1.0 / self.weights[plan]
+            self.in_use += 1
+            self._account(plan, time.monotonic() - w.t0)
+            w.fut.set_result(True)
+
+    def stats(self) -> Dict:
+        out = {"capacity": self.capacity, "in_use": self.in_use, "plans": {}}
+        for plan, waits in self.waits.items():
+            xs: List[float] = sorted(waits)
+            n = len(xs)
+            out["plans"][plan] = {
+                "weight": self.weights[plan],
+                "queued": len(self.queues[plan]),
+                **self.counters[plan],
+                "wait_avg_ms": round(1000 * sum(xs) / n, 1) if n else 0.0,
+                "wait_p50_ms": round(1000 * xs[n // 2], 1) if n else 0.0,
+                "wait_p95_ms": round(1000 * xs[min(n - 1, int(n * 0.95))], 1) if n else 0.0,
+                "wait_max_ms": round(1000 * xs[-1], 1) if n else 0.0,
+            }
+        return out
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """'free:1,standard:3' -> {'free': 1.0, 'standard': 3.0}"""
+    out: Dict[str, float] = {}
+    for part in (spec or "").split(","):
+        if ":" in part:
+            k, v = part.split(":", 1)
+            out[k.strip()] = float(v)
+    return out
@@ -1,12 +1,14 @@
-import os, requests, hmac, hashlib
+import os, hmac, hashlib, asyncio
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from telegram import Update, BotCommand
-from bot import build_application
+import profiler
+from bot import build_application, http_client, close_http_client, start_workers, stop_workers, SCHED, ANALYTICS
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN","")
 PUBLIC_BASE_URL    = os.getenv("PUBLIC_BASE_URL","")  # например: https://ai-bot-telegram.onrender.com
 TRIBUTE_WEBHOOK_SECRET = os.getenv("TRIBUTE_WEBHOOK_SECRET","changeme")
+ADMIN_API_TOKEN    = os.getenv("ADMIN_API_TOKEN","")  # для служебных эндпоинтов: заголовок X-Admin-Token
 
 app = FastAPI()
 application = None
@@ -17,6 +19,8 @@ async def _startup():
     application = build_application()
     await application.initialize()
     await application.start()
+    await start_workers(application.bot)
+    await profiler.LOOP.start()
     # меню команд (выпадающий список)
     try:
         await application.bot.set_my_commands([
@@ -33,28 +37,72 @@ async def _startup():
 
 @app.on_event("shutdown")
 async def _shutdown():
+    await profiler.LOOP.stop()
+    await stop_workers()
     if application:
         await application.stop()
+    await close_http_client()
 
 @app.get("/")
 async def root():
     return {"ok": True}
 
+def _require_admin(request: Request):
+    sent = request.headers.get("x-admin-token", "")
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(sent, ADMIN_API_TOKEN):
+        raise HTTPException(403, "forbidden")
+
+# Очередь к моделям: ожидание по тарифам (avg/p50/p95/max), снятые по дедлайну
+@app.get("/metrics/scheduler")
+async def scheduler_metrics(request: Request):
+    _require_admin(request)
+    return SCHED.stats()
+
+# Сводка из агрегатов (stats_daily / stats_latency), не из сырых таблиц
+@app.get("/stats")
+async def stats(request: Request, days: int = 7):
+    _require_admin(request)
+    return ANALYTICS.report(max(1, min(days, 366)))
+
 # Вебхук Телеграма — сюда Telegram шлёт апдейты
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     data = await request.json()
-    update = Update.de_json(data, application.bot)
-    await application.process_update(update)
+    kind = next((k for k in data if k != "update_id"), "?")
+    with profiler.trace("update", update_id=data.get("update_id"), type=kind):
+        update = Update.de_json(data, application.bot)
+        await application.process_update(update)
     return {"ok": True}
 
+# ===== Диагностика (только с X-Admin-Token) =====
+# Сэмплирующий профайлер: collapsed stacks для flamegraph.pl / speedscope
+@app.get("/debug/profile", response_class=PlainTextResponse)
+async def debug_profile(request: Request, seconds: float = 10, interval_ms: float = 5):
+    _require_admin(request)
+    try:
+        return await asyncio.to_thread(profiler.sample, max(0.1, min(seconds, 60)), max(1, interval_ms) / 1000)
+    except RuntimeError as e:
+        raise HTTPException(409, str(e))
+
+# Самые медленные недавние апдейты с разбивкой по этапам
+@app.get("/debug/slow")
+async def debug_slow(request: Request):
+    _require_admin(request)
+    return profiler.SLOW.report()
+
+# Лаг event loop и стеки вызовов, которые его блокировали
+@app.get("/debug/loop")
+async def debug_loop(request: Request):
+    _require_admin(request)
+    return profiler.LOOP.report()
+
 # Установка вебхука (вызов извне: curl -X POST https://.../set_webhook)
 @app.post("/set_webhook")
 async def set_webhook():
     if not PUBLIC_BASE_URL:
         raise HTTPException(400, "PUBLIC_BASE_URL not set")
     url = f"{PUBLIC_BASE_URL.rstrip('/')}/webhook"
-    r = requests.post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook", data={"url": url}, timeout=20)
+    r = await http_client().post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook", data={"url": url}, timeout=20)
     try:
         return r.json()
     except Exception: